@@ -57,7 +57,11 @@ class LocalInferenceService: ObservableObject {
             guard let modelURL = Bundle.main.url(forResource: "PanDerm", withExtension: "mlpackage") else {
                 throw LocalInferenceError.modelNotLoaded
             }
-            panDermModel = try MLModel(contentsOf: modelURL, configuration: MLModelConfiguration())
+            // Pin to CPU + Neural Engine: `.all` lets Core ML split the graph across
+            // CPU/GPU/ANE, and the transfers between them cost more than they save.
+            let configuration = MLModelConfiguration()
+            configuration.computeUnits = .cpuAndNeuralEngine
+            panDermModel = try MLModel(contentsOf: modelURL, configuration: configuration)
             
             await MainActor.run {
                 isModelLoaded = true
@@ -198,8 +202,8 @@ class LocalInferenceService: ObservableObject {
     }
     
     private func postprocessResults(_ output: MLFeatureProvider, originalImage: UIImage) -> [ClassificationResult] {
-        // The output name is `linear_48` as seen in the Xcode model inspector.
-        guard let multiArray = output.featureValue(for: "linear_48")?.multiArrayValue else {
+        // The conversion script names the classifier output `logits`.
+        guard let multiArray = output.featureValue(for: "logits")?.multiArrayValue else {
             return []
         }
         return parseMultiArray(multiArray, originalImage: originalImage)
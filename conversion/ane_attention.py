@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Neural Engine Friendly Attention for PanDerm
+This module rewrites the ViT attention blocks into the (B, C, 1, N) layout
+recommended by Apple's "Deploying Transformers on the Apple Neural Engine"
+so that Core ML can schedule attention on the Neural Engine.
+"""
+
+import torch
+import torch.nn as nn
+
+
+class ANEAttention(nn.Module):
+    """Multi-head self-attention using 1x1 convolutions on (B, C, 1, N) tensors"""
+
+    def __init__(self, dim, num_heads, scale, qkv_bias=True, relative_position_bias=None):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_dim = dim // num_heads
+        self.scale = scale
+
+        self.q_proj = nn.Conv2d(dim, dim, 1, bias=qkv_bias)
+        self.k_proj = nn.Conv2d(dim, dim, 1, bias=qkv_bias)
+        self.v_proj = nn.Conv2d(dim, dim, 1, bias=qkv_bias)
+        self.out_proj = nn.Conv2d(dim, dim, 1)
+
+        # Fixed per-head bias of shape (1, H, N, N), precomputed from the lookup table
+        if relative_position_bias is not None:
+            self.register_buffer("relative_position_bias", relative_position_bias)
+        else:
+            self.relative_position_bias = None
+
+    @staticmethod
+    def is_supported(module):
+        """Check whether an attention module can be rewritten"""
+        if not isinstance(getattr(module, "qkv", None), nn.Linear):
+            return False
+        if not isinstance(getattr(module, "proj", None), nn.Linear):
+            return False
+        # BEiT's attn_head_dim makes the head width differ from the embedding width
+        dim = module.qkv.in_features
+        if module.qkv.out_features != 3 * dim or module.proj.in_features != dim:
+            return False
+        # Per-head q/k normalisation is not part of the ANE recipe
+        for name in ("q_norm", "k_norm"):
+            if not isinstance(getattr(module, name, nn.Identity()), nn.Identity):
+                return False
+        return hasattr(module, "num_heads") and hasattr(module, "scale")
+
+    @classmethod
+    def from_attention(cls, module):
+        """Build an ANEAttention from a timm/BEiT style Attention module"""
+        dim = module.qkv.in_features
+
+        # timm stores the qkv bias on the Linear, BEiT keeps separate q/v biases
+        qkv_bias = module.qkv.bias
+        if qkv_bias is None and getattr(module, "q_bias", None) is not None:
+            qkv_bias = torch.cat((
+                module.q_bias,
+                torch.zeros_like(module.v_bias, requires_grad=False),
+                module.v_bias
+            ))
+
+        # Computed without autograd so the buffer is a plain leaf tensor (deepcopy-able)
+        relative_position_bias = None
+        if getattr(module, "relative_position_bias_table", None) is not None:
+            with torch.no_grad():
+                num_tokens = module.relative_position_index.shape[0]
+                relative_position_bias = module.relative_position_bias_table[
+                    module.relative_position_index.view(-1)
+                ].view(num_tokens, num_tokens, -1)
+                relative_position_bias = relative_position_bias.permute(2, 0, 1).unsqueeze(0).contiguous()
+
+        ane_module = cls(
+            dim,
+            module.num_heads,
+            module.scale,
+            qkv_bias=qkv_bias is not None,
+            relative_position_bias=relative_position_bias
+        )
+
+        # Linear -> Conv2d weights: (out, in) -> (out, in, 1, 1)
+        with torch.no_grad():
+            q_weight, k_weight, v_weight = module.qkv.weight.chunk(3, dim=0)
+            ane_module.q_proj.weight.copy_(q_weight.view(dim, dim, 1, 1))
+            ane_module.k_proj.weight.copy_(k_weight.view(dim, dim, 1, 1))
+            ane_module.v_proj.weight.copy_(v_weight.view(dim, dim, 1, 1))
+            if qkv_bias is not None:
+                q_bias, k_bias, v_bias = qkv_bias.chunk(3, dim=0)
+                ane_module.q_proj.bias.copy_(q_bias)
+                ane_module.k_proj.bias.copy_(k_bias)
+                ane_module.v_proj.bias.copy_(v_bias)
+            ane_module.out_proj.weight.copy_(module.proj.weight.view(dim, dim, 1, 1))
+            ane_module.out_proj.bias.copy_(module.proj.bias)
+
+        return ane_module.eval()
+
+    def forward(self, x, rel_pos_bias=None, attn_mask=None):
+        if attn_mask is not None:
+            raise NotImplementedError("ANEAttention does not support attn_mask")
+
+        batch_size, num_tokens, channels = x.shape
+        heads = self.num_heads
+
+        # (B, N, C) -> (B, C, 1, N)
+        x = x.transpose(1, 2).unsqueeze(2)
+
+        q = self.q_proj(x) * self.scale
+        k = self.k_proj(x)
+        v = self.v_proj(x)
+
+        # Split heads: (B, C, 1, N) -> (B * H, d, N)
+        q = q.reshape(-1, self.head_dim, num_tokens)
+        k = k.reshape(-1, self.head_dim, num_tokens)
+        v = v.reshape(-1, self.head_dim, num_tokens)
+
+        attn = torch.bmm(q.transpose(1, 2), k)
+
+        if self.relative_position_bias is not None or rel_pos_bias is not None:
+            attn = attn.view(batch_size, heads, num_tokens, num_tokens)
+            if self.relative_position_bias is not None:
+                attn = attn + self.relative_position_bias
+            if rel_pos_bias is not None:
+                attn = attn + rel_pos_bias
+            attn = attn.view(-1, num_tokens, num_tokens)
+
+        attn = attn.softmax(dim=-1)
+
+        # (B * H, d, N) -> (B, C, 1, N)
+        out = torch.bmm(v, attn.transpose(1, 2))
+        out = out.reshape(batch_size, channels, 1, num_tokens)
+        out = self.out_proj(out)
+
+        # (B, C, 1, N) -> (B, N, C)
+        return out.squeeze(2).transpose(1, 2)
+
+
+def replace_attention_modules(model):
+    """Swap every supported Attention module in the model for ANEAttention"""
+    replacements = []
+    for _, parent in model.named_modules():
+        for child_name, child in parent.named_children():
+            if type(child).__name__ == "Attention" and ANEAttention.is_supported(child):
+                replacements.append((parent, child_name, child))
+
+    for parent, child_name, child in replacements:
+        setattr(parent, child_name, ANEAttention.from_attention(child))
+
+    return len(replacements)
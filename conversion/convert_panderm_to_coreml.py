@@ -7,57 +7,104 @@ for integration into the iOS app.
 
 import os
 import sys
+import argparse
+import hashlib
+import importlib.util
+import inspect
+import pickle
 import torch
 import torch.nn as nn
 import coremltools as ct
 import numpy as np
 from pathlib import Path
 
+from ane_attention import replace_attention_modules
+
+# (module name, pip package) pairs checked by setup_environment
+REQUIRED_PACKAGES = [
+    ("timm", "timm"),
+    ("torch", "torch"),
+    ("torchvision", "torchvision"),
+    ("coremltools", "coremltools"),
+    ("numpy", "numpy")
+]
+
+# ImageNet normalization used during PanDerm training
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# Core ML image inputs apply one scale to all channels, the per-channel
+# remainder is folded into the patch embedding by fold_channel_std
+INPUT_STD = float(np.mean(IMAGENET_STD))
+
+# Image types accepted by --calibrate
+CALIBRATION_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# Bump for capture changes the cache key can't see (e.g. dependency behaviour),
+# so cached graphs from the old recipe are not reused
+CAPTURE_RECIPE_VERSION = 4
+
 # Add the model directory to the path
-sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'model', 'classification'))
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model', 'classification')
+sys.path.append(MODEL_DIR)
 
 def setup_environment():
     """Setup and verify required packages"""
     print("Setting up environment...")
     
-    try:
-        import timm
-        print("✅ timm already installed")
-    except ImportError:
-        print("❌ timm not found. Please install: pip install timm")
-        return False
+    # find_spec checks availability without running the module's import code
+    missing = [package for module, package in REQUIRED_PACKAGES if importlib.util.find_spec(module) is None]
     
-    try:
-        import torch
-        print("✅ torch already installed")
-    except ImportError:
-        print("❌ torch not found. Please install: pip install torch")
-        return False
+    for module, package in REQUIRED_PACKAGES:
+        if package in missing:
+            print(f"❌ {module} not found. Please install: pip install {package}")
+        else:
+            print(f"✅ {module} already installed")
     
-    try:
-        import torchvision
-        print("✅ torchvision already installed")
-    except ImportError:
-        print("❌ torchvision not found. Please install: pip install torchvision")
-        return False
+    return not missing
+
+def use_tanh_gelu(model):
+    """Swap exact GELU activations for the tanh approximation, a single Neural Engine op"""
+    replacements = []
+    for _, parent in model.named_modules():
+        for child_name, child in parent.named_children():
+            if isinstance(child, nn.GELU) and child.approximate == "none":
+                replacements.append((parent, child_name))
     
-    try:
-        import coremltools
-        print("✅ coremltools already installed")
-    except ImportError:
-        print("❌ coremltools not found. Please install: pip install coremltools")
-        return False
+    for parent, child_name in replacements:
+        setattr(parent, child_name, nn.GELU(approximate="tanh"))
     
-    try:
-        import numpy
-        print("✅ numpy already installed")
-    except ImportError:
-        print("❌ numpy not found. Please install: pip install numpy")
-        return False
+    return len(replacements)
+
+def fold_channel_std(model):
+    """Rescale the patch embedding input channels so inputs normalized by INPUT_STD are exact"""
+    proj = getattr(getattr(model, "patch_embed", None), "proj", None)
+    if not isinstance(proj, nn.Conv2d):
+        raise RuntimeError("Model has no patch_embed.proj convolution to fold the normalization into")
     
-    return True
+    # (x - mean) / std == (x - mean) / INPUT_STD * (INPUT_STD / std), and the conv is linear
+    with torch.no_grad():
+        for channel, std in enumerate(IMAGENET_STD):
+            proj.weight[:, channel] *= INPUT_STD / std
 
-def load_panderm_model(checkpoint_path):
+def load_checkpoint(checkpoint_path, allow_unsafe_pickle=False):
+    """Load checkpoint tensors without unpickling arbitrary objects unless explicitly allowed"""
+    try:
+        try:
+            # Memory-map tensor storages instead of copying them
+            return torch.load(checkpoint_path, map_location='cpu', weights_only=True, mmap=True)
+        except (TypeError, RuntimeError):
+            # torch < 2.1 has no mmap argument, legacy (non-zip) files can't be mapped
+            return torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError:
+        if not allow_unsafe_pickle:
+            print("❌ Checkpoint contains non-tensor objects that weights_only loading refuses")
+            print("Re-run with --allow-unsafe-pickle only if you trust the checkpoint source")
+            raise
+        print("⚠️  Unpickling the full checkpoint (--allow-unsafe-pickle)")
+        return torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+
+def load_panderm_model(checkpoint_path, ane_attention=True, tanh_gelu=True, allow_unsafe_pickle=False):
     """Load PanDerm model using the correct approach"""
     print("Loading PanDerm model...")
     
@@ -69,14 +116,29 @@ def load_panderm_model(checkpoint_path):
         model = panderm_base_patch16_224()
         
         # Load the checkpoint
-        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        checkpoint = load_checkpoint(checkpoint_path, allow_unsafe_pickle=allow_unsafe_pickle)
         
-        # Load state dict
-        model.load_state_dict(checkpoint, strict=False)
+        # Load state dict, reusing the loaded storages where supported
+        try:
+            model.load_state_dict(checkpoint, strict=False, assign=True)
+        except TypeError:
+            model.load_state_dict(checkpoint, strict=False)
         
         # Set to evaluation mode
         model.eval()
         
+        fold_channel_std(model)
+        print("✅ Folded per-channel normalization into the patch embedding")
+        
+        # Rewrite attention into the Neural Engine friendly layout
+        if ane_attention:
+            replaced = replace_attention_modules(model)
+            print(f"✅ Rewrote {replaced} attention blocks for the Neural Engine")
+        
+        if tanh_gelu:
+            replaced = use_tanh_gelu(model)
+            print(f"✅ Switched {replaced} GELU activations to the tanh approximation")
+        
         print("✅ Model loaded successfully")
         return model
         
@@ -84,7 +146,166 @@ def load_panderm_model(checkpoint_path):
         print(f"❌ Error loading PanDerm model: {str(e)}")
         return None
 
-def convert_to_coreml(model, output_path):
+def load_calibration_images(calibration_dir):
+    """Yield normalized (1, 3, 224, 224) tensors for the images in a directory"""
+    from PIL import Image
+    from torchvision import transforms
+    
+    # Same normalization as the Core ML image input, see fold_channel_std
+    transform = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, [INPUT_STD] * 3)
+    ])
+    
+    for path in sorted(Path(calibration_dir).iterdir()):
+        if path.suffix.lower() in CALIBRATION_EXTENSIONS:
+            with Image.open(path) as image:
+                yield transform(image.convert("RGB")).unsqueeze(0)
+
+def calibrate_model(model, calibration_dir):
+    """Quantize weights to int8 in PyTorch with activation ranges calibrated on sample images"""
+    print(f"Calibrating int8 quantization on images in {calibration_dir}...")
+    
+    try:
+        from coremltools.optimize.torch.quantization import LinearQuantizer, LinearQuantizerConfig
+        
+        config = LinearQuantizerConfig.from_dict({
+            "global_config": {
+                "quantization_scheme": "symmetric",
+                "milestones": [0, 0, 10, 10]
+            }
+        })
+        quantizer = LinearQuantizer(model, config)
+        prepared_model = quantizer.prepare(example_inputs=(torch.randn(1, 3, 224, 224),), inplace=True)
+        
+        num_images = 0
+        with torch.no_grad():
+            for image in load_calibration_images(calibration_dir):
+                quantizer.step()
+                prepared_model(image)
+                num_images += 1
+        
+        if num_images == 0:
+            print(f"❌ No calibration images found in {calibration_dir}")
+            return None
+        
+        quantized_model = quantizer.finalize(inplace=True).eval()
+        
+        print(f"✅ Calibrated on {num_images} images")
+        return quantized_model
+        
+    except Exception as e:
+        print(f"❌ Error calibrating model: {str(e)}")
+        return None
+
+def quantize_model(mlmodel, precision):
+    """Compress Core ML model weights to the requested precision"""
+    # ML Program weights are already stored as fp16 via compute_precision
+    if precision != "int8":
+        return mlmodel
+    
+    print(f"Quantizing weights to {precision}...")
+    
+    import coremltools.optimize.coreml as cto
+    config = cto.OptimizationConfig(
+        global_config=cto.OpLinearQuantizerConfig(mode="linear_symmetric", dtype="int8")
+    )
+    return cto.linear_quantize_weights(mlmodel, config=config)
+
+def calibration_fingerprint(calibration_dir):
+    """Names, sizes and mtimes of the calibration images, for the cache key"""
+    if not calibration_dir:
+        return None
+    
+    return [
+        (path.name, path.stat().st_size, path.stat().st_mtime)
+        for path in sorted(Path(calibration_dir).iterdir())
+        if path.suffix.lower() in CALIBRATION_EXTENSIONS
+    ]
+
+def source_hash():
+    """Hash of the code that shapes the captured graph: model definition, rewrites and capture"""
+    digest = hashlib.sha1()
+    
+    source_files = [
+        os.path.join(MODEL_DIR, "models", "modeling_finetune.py"),
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "ane_attention.py")
+    ]
+    for path in source_files:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    
+    for function in (load_checkpoint, load_panderm_model, use_tanh_gelu, calibrate_model, export_model, trace_model):
+        digest.update(inspect.getsource(function).encode())
+    
+    return digest.hexdigest()
+
+def get_cache_paths(checkpoint_path, *options):
+    """Cache file paths for the captured graphs, keyed by checkpoint, code, torch version and options"""
+    fingerprint = ":".join(str(part) for part in (
+        os.path.abspath(checkpoint_path),
+        os.path.getmtime(checkpoint_path),
+        torch.__version__,
+        CAPTURE_RECIPE_VERSION,
+        source_hash(),
+        *options
+    ))
+    cache_key = hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+    cache_dir = os.path.dirname(checkpoint_path)
+    return {
+        "exported": os.path.join(cache_dir, f"exported_{cache_key}.pt2"),
+        "traced": os.path.join(cache_dir, f"traced_{cache_key}.pt")
+    }
+
+def remove_stale_cache(cache_path):
+    """Delete cached graphs of the same kind with a different key, each is a full weight copy"""
+    cache_dir = Path(cache_path).parent
+    kind = Path(cache_path).name.split("_")[0]
+    for path in cache_dir.glob(f"{kind}_*{Path(cache_path).suffix}"):
+        if path.name != Path(cache_path).name:
+            print(f"Removing stale cached graph: {path}")
+            path.unlink()
+
+def export_model(model, dummy_input, cache_path=None):
+    """Capture the model with torch.export, reusing a cached ExportedProgram"""
+    if cache_path and os.path.exists(cache_path):
+        print(f"Using cached ExportedProgram: {cache_path}")
+        return torch.export.load(cache_path)
+    
+    # Core ML converts the ATEN dialect, not the TRAINING dialect export returns
+    exported_program = torch.export.export(model, (dummy_input,)).run_decompositions({})
+    if cache_path:
+        remove_stale_cache(cache_path)
+        torch.export.save(exported_program, cache_path)
+    return exported_program
+
+def trace_model(model, dummy_input, cache_path=None, freeze=True):
+    """Capture the model with torch.jit.trace, reusing a cached TorchScript module"""
+    if cache_path and os.path.exists(cache_path):
+        print(f"Using cached TorchScript model: {cache_path}")
+        return torch.jit.load(cache_path)
+    
+    # Trace in channels-last so the graph carries fewer layout fixups,
+    # warming up once so lazily initialised state is settled before capture
+    model = model.to(memory_format=torch.channels_last)
+    dummy_input = dummy_input.to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        model(dummy_input)
+    
+    traced_model = torch.jit.trace(model, dummy_input).eval()
+    
+    # Freezing inlines attributes and folds constants (patch grid, pos-embed slicing)
+    if freeze:
+        traced_model = torch.jit.freeze(traced_model)
+    if cache_path:
+        remove_stale_cache(cache_path)
+        traced_model.save(cache_path)
+    return traced_model
+
+def convert_to_coreml(model, output_path, precision="fp16", cache_paths=None, calibrated=False):
     """Convert PyTorch model to Core ML"""
     print("Converting to Core ML...")
     
@@ -92,17 +313,66 @@ def convert_to_coreml(model, output_path):
         # Create dummy input for tracing
         dummy_input = torch.randn(1, 3, 224, 224)
         
-        # Trace the model
-        traced_model = torch.jit.trace(model, dummy_input)
+        # Image input lets Core ML take the CVPixelBuffer directly and fold the
+        # normalization into the graph. Core ML applies one scale to all channels,
+        # so the shared INPUT_STD is used and the per-channel std lives in the model.
+        image_input = ct.ImageType(
+            name="input",
+            shape=dummy_input.shape,
+            scale=1.0 / (255.0 * INPUT_STD),
+            bias=[-mean / INPUT_STD for mean in IMAGENET_MEAN],
+            color_layout=ct.colorlayout.RGB
+        )
         
-        # Convert to Core ML
-        mlmodel = ct.convert(
-            traced_model,
-            inputs=[ct.TensorType(name="input", shape=dummy_input.shape)],
-            minimum_deployment_target=ct.target.iOS15,
+        # ML Program on iOS 17 enables Neural Engine scheduling and fp16 compute
+        convert_options = dict(
+            inputs=[image_input],
+            # fp16 compute would otherwise make the output fp16, the app reads Float32
+            outputs=[ct.TensorType(name="logits", dtype=np.float32)],
+            convert_to="mlprogram",
+            minimum_deployment_target=ct.target.iOS17,
+            compute_precision=ct.precision.FLOAT32 if precision == "fp32" else ct.precision.FLOAT16,
             compute_units=ct.ComputeUnit.CPU_AND_NE
         )
         
+        cache_paths = cache_paths or {}
+        exported_cache = cache_paths.get("exported")
+        traced_cache = cache_paths.get("traced")
+        
+        # Prefer torch.export, fall back to tracing for unsupported graphs.
+        # model is None when main() found a cached graph and skipped loading.
+        # torch.export can't capture quantized tensors, calibrated models go straight to tracing.
+        mlmodel = None
+        if not calibrated and (model is not None or (exported_cache and os.path.exists(exported_cache))):
+            try:
+                exported_program = export_model(model, dummy_input, exported_cache)
+                mlmodel = ct.convert(exported_program, **convert_options)
+                print("✅ Converted using torch.export")
+            except Exception as e:
+                print(f"⚠️  torch.export conversion failed: {str(e)}")
+                # Don't let an unconvertible program be reused by later runs
+                if exported_cache and os.path.exists(exported_cache):
+                    os.remove(exported_cache)
+        
+        if mlmodel is None:
+            if model is None and not (traced_cache and os.path.exists(traced_cache)):
+                raise RuntimeError("No usable cached graph, re-run to capture the model again")
+            print("Falling back to torch.jit.trace...")
+            # Freezing folds calibrated weights into QInt8 constants that coremltools rejects
+            traced_model = trace_model(model, dummy_input, traced_cache, freeze=not calibrated)
+            mlmodel = ct.convert(traced_model, **convert_options)
+            print("✅ Converted using torch.jit.trace")
+        
+        # Compress weights (the Neural Engine only executes fp16). Calibrated
+        # models already carry int8 weights from the PyTorch quantizer.
+        if not calibrated:
+            mlmodel = quantize_model(mlmodel, precision)
+        
+        mlmodel.short_description = (
+            "PanDerm skin condition classifier. "
+            "Load with MLModelConfiguration.computeUnits = .cpuAndNeuralEngine."
+        )
+        
         # Save the model
         mlmodel.save(output_path)
         
@@ -113,10 +383,57 @@ def convert_to_coreml(model, output_path):
         print(f"❌ Error converting to Core ML: {str(e)}")
         return False
 
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Convert PanDerm PyTorch model to Core ML")
+    parser.add_argument(
+        "--precision",
+        choices=["fp32", "fp16", "int8"],
+        default="fp16",
+        help="Weight precision of the exported model (default: fp16)"
+    )
+    parser.add_argument(
+        "--no-ane-attention",
+        dest="ane_attention",
+        action="store_false",
+        help="Keep the original attention blocks instead of the Neural Engine layout"
+    )
+    parser.add_argument(
+        "--exact-gelu",
+        dest="tanh_gelu",
+        action="store_false",
+        help="Keep the exact (erf) GELU instead of the tanh approximation"
+    )
+    parser.add_argument(
+        "--calibrate",
+        metavar="DIR",
+        help="Calibrate int8 weight quantization in PyTorch on the images in DIR "
+             "(default: post-conversion quantization only)"
+    )
+    parser.add_argument(
+        "--allow-unsafe-pickle",
+        action="store_true",
+        help="Allow full unpickling of checkpoints that weights_only loading rejects "
+             "(can execute arbitrary code; only for trusted files)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="Re-capture the PyTorch graph instead of reusing the cached one"
+    )
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    
     print("🚀 PanDerm to Core ML Conversion")
     print("=" * 50)
     
+    if args.calibrate and not os.path.isdir(args.calibrate):
+        print(f"❌ Calibration directory not found: {args.calibrate}")
+        return
+    
     # Setup environment
     if not setup_environment():
         print("❌ Environment setup failed")
@@ -134,18 +451,51 @@ def main():
     
     print(f"Found checkpoint: {checkpoint_path}")
     
-    # Load model
-    model = load_panderm_model(checkpoint_path)
-    if model is None:
-        print("❌ Failed to load model")
-        return
+    # Captured graphs depend on every option that changes the PyTorch model
+    cache_paths = None
+    if args.cache:
+        cache_paths = get_cache_paths(
+            checkpoint_path,
+            args.ane_attention,
+            args.tanh_gelu,
+            calibration_fingerprint(args.calibrate)
+        )
+    
+    # A cached graph makes loading and calibrating the PyTorch model unnecessary
+    if cache_paths and any(os.path.exists(path) for path in cache_paths.values()):
+        print("Found cached graph, skipping model load")
+        model = None
+    else:
+        # Load model
+        model = load_panderm_model(
+            checkpoint_path,
+            ane_attention=args.ane_attention,
+            tanh_gelu=args.tanh_gelu,
+            allow_unsafe_pickle=args.allow_unsafe_pickle
+        )
+        if model is None:
+            print("❌ Failed to load model")
+            return
+        
+        # Calibrated quantization keeps accuracy where post-conversion int8 degrades it
+        if args.calibrate:
+            model = calibrate_model(model, args.calibrate)
+            if model is None:
+                print("❌ Failed to calibrate model")
+                return
     
     # Convert to Core ML
-    if convert_to_coreml(model, output_path):
+    if convert_to_coreml(
+        model,
+        output_path,
+        precision=args.precision,
+        cache_paths=cache_paths,
+        calibrated=bool(args.calibrate)
+    ):
         print("\n🎉 Conversion completed successfully!")
         print(f"Core ML model saved to: {output_path}")
         print("\nNext steps:")
-        print("1. Add the .mlmodel file to your Xcode project")
+        print("1. Add the .mlpackage to your Xcode project")
         print("2. Build and test the iOS app")
     else:
         print("❌ Conversion failed")
@@ -6,11 +6,26 @@ This script downloads the official PanDerm model weights from Google Drive.
 
 import os
 import sys
+import mmap
+import hashlib
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+DOWNLOAD_WORKERS = 8
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+def sha256_file(path, chunk_size=8 * 1024 * 1024):
+    """Compute the SHA-256 of a file on disk"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def download_file_from_google_drive(file_id, destination):
-    """Download a file from Google Drive using the file ID"""
+    """Download a file from Google Drive using the file ID, returns its SHA-256"""
     
     def get_confirm_token(response):
         for key, value in response.cookies.items():
@@ -19,12 +34,122 @@ def download_file_from_google_drive(file_id, destination):
         return None
 
     def save_response_content(response, destination):
-        CHUNK_SIZE = 32768
+        CHUNK_SIZE = 8 * 1024 * 1024
+        
+        # Hash while writing so verification needs no second read of the file
+        digest = hashlib.sha256()
+        
+        # Linux: bypass the page cache with O_DIRECT
+        if hasattr(os, "O_DIRECT"):
+            try:
+                fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+            except OSError:
+                fd = None  # filesystem does not support O_DIRECT
+            if fd is not None:
+                save_response_content_direct(response, fd, destination, CHUNK_SIZE, digest)
+                return digest.hexdigest()
         
         with open(destination, "wb") as f:
             for chunk in response.iter_content(CHUNK_SIZE):
                 if chunk:  # filter out keep-alive new chunks
+                    digest.update(chunk)
                     f.write(chunk)
+        
+        return digest.hexdigest()
+
+    def save_response_content_direct(response, fd, destination, chunk_size, digest):
+        # Anonymous mmap memory is page aligned, as O_DIRECT requires
+        buffer = mmap.mmap(-1, chunk_size)
+        filled = 0
+        written = 0
+        
+        try:
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    digest.update(chunk)
+                    view = memoryview(chunk)
+                    while view:
+                        count = min(len(view), chunk_size - filled)
+                        buffer[filled:filled + count] = view[:count]
+                        filled += count
+                        view = view[count:]
+                        if filled == chunk_size:
+                            # A short O_DIRECT write cannot be resumed at an unaligned offset
+                            wrote = os.write(fd, buffer)
+                            if wrote != chunk_size:
+                                raise OSError(f"Short write: {wrote} of {chunk_size} bytes")
+                            written += chunk_size
+                            filled = 0
+            finally:
+                os.close(fd)
+            
+            # O_DIRECT only accepts block-aligned lengths, write the tail buffered
+            if filled:
+                with open(destination, "r+b") as f:
+                    f.seek(written)
+                    f.write(buffer[:filled])
+        finally:
+            buffer.close()
+
+    def save_response_in_segments(session, response, destination):
+        """Download with parallel HTTP Range requests, returns None if unsupported"""
+        if not hasattr(os, "pwrite"):
+            return None
+        
+        url = response.url
+        head = session.head(url, allow_redirects=True)
+        size = int(head.headers.get("Content-Length", 0))
+        if size <= SEGMENT_SIZE:
+            return None
+        
+        # Servers that ignore Range answer 200 with the full body
+        probe = session.get(url, headers={"Range": "bytes=0-0"}, stream=True)
+        probe.close()
+        if probe.status_code != 206:
+            return None
+        
+        response.close()
+        
+        with open(destination, "wb") as f:
+            f.truncate(size)
+        
+        # requests.Session is not thread-safe, so each worker gets its own copy
+        worker_state = threading.local()
+        
+        def get_worker_session():
+            if not hasattr(worker_state, "session"):
+                worker_state.session = requests.Session()
+                worker_state.session.headers.update(session.headers)
+                worker_state.session.cookies.update(session.cookies)
+            return worker_state.session
+        
+        def download_segment(fd, start, end):
+            segment = get_worker_session().get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True)
+            segment.raise_for_status()
+            if segment.status_code != 206:
+                raise IOError(f"Range request for bytes {start}-{end} was not honoured")
+            offset = start
+            for chunk in segment.iter_content(1024 * 1024):
+                if chunk:
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+            if offset != end + 1:
+                raise IOError(f"Incomplete segment: got {offset - start} of {end - start + 1} bytes")
+        
+        fd = os.open(destination, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+                futures = [
+                    executor.submit(download_segment, fd, start, min(start + SEGMENT_SIZE, size) - 1)
+                    for start in range(0, size, SEGMENT_SIZE)
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+        
+        # Segments arrive out of order, so hash the (page-cached) file afterwards
+        return sha256_file(destination)
 
     url = "https://docs.google.com/uc?export=download"
     session = requests.Session()
@@ -36,7 +161,19 @@ def download_file_from_google_drive(file_id, destination):
         params = {'id': file_id, 'confirm': token}
         response = session.get(url, params=params, stream=True)
 
-    save_response_content(response, destination)
+    # Write to a .part file so a failed download never leaves a full-size
+    # file with gaps at the checkpoint path
+    partial = Path(f"{destination}.part")
+    try:
+        digest = save_response_in_segments(session, response, partial)
+        if digest is None:
+            digest = save_response_content(response, partial)
+        os.replace(partial, destination)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    
+    return digest
 
 def main():
     """Download PanDerm weights"""
@@ -53,13 +190,15 @@ def main():
             "name": "PanDerm_Base",
             "file_id": "17J4MjsZu3gdBP6xAQi_NMDVvH65a00HB",
             "filename": "panderm_bb_data6_checkpoint-499.pth",
-            "size": "~400MB"
+            "size": "~400MB",
+            "sha256": None  # not yet published; fill in to enforce verification
         },
         "2": {
             "name": "PanDerm_Large", 
             "file_id": "1SwEzaOlFV_gBKf2UzeowMC8z9UH7AQbE",
             "filename": "panderm_ll_data6_checkpoint-499.pth",
-            "size": "~1.2GB"
+            "size": "~1.2GB",
+            "sha256": None  # not yet published; fill in to enforce verification
         }
     }
     
@@ -82,13 +221,26 @@ def main():
     print("\nThis may take several minutes depending on your internet connection.")
     
     try:
-        download_file_from_google_drive(model["file_id"], destination)
+        digest = download_file_from_google_drive(model["file_id"], destination)
+        
+        # Verify checksum
+        if model["sha256"] and digest != model["sha256"]:
+            print(f"\n❌ Checksum mismatch for {model['name']}")
+            print(f"Expected SHA-256: {model['sha256']}")
+            print(f"Actual SHA-256:   {digest}")
+            destination.unlink()
+            print("The corrupted download was removed. Please try again.")
+            return False
+        
         print(f"\n✅ Successfully downloaded {model['name']}!")
         print(f"File saved to: {destination}")
         
         # Verify file size
         file_size = destination.stat().st_size / (1024 * 1024)  # MB
         print(f"File size: {file_size:.1f} MB")
+        print(f"SHA-256: {digest}")
+        if not model["sha256"]:
+            print("⚠️  No known checksum for this model, integrity was not verified")
         
         print(f"\n🎉 Ready for conversion!")
         print("Run: python3 convert_panderm_to_coreml.py")
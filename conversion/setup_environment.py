@@ -8,16 +8,58 @@ import subprocess
 import sys
 import os
 
+# pip reports this when no release fits, e.g. no wheel under --only-binary
+NO_MATCHING_DISTRIBUTION = "No matching distribution found"
+
+# Network failures also end in "no matching distribution", a source build can't help there
+NETWORK_ERRORS = (
+    "NewConnectionError",
+    "ConnectTimeoutError",
+    "Max retries exceeded",
+    "Temporary failure in name resolution"
+)
+
+def pip_install(*args, allow_source_build=True):
+    """Run pip install preferring prebuilt wheels, retrying with source builds when a wheel is missing"""
+    command = [sys.executable, "-m", "pip", "install", "--prefer-binary", *args]
+    
+    # Wheels only: avoids multi-minute compiles of opencv, scikit-learn, etc.
+    result = subprocess.run(command[:4] + ["--only-binary=:all:"] + command[4:], stderr=subprocess.PIPE, text=True)
+    if result.returncode == 0:
+        return
+    sys.stderr.write(result.stderr)
+    
+    missing_wheel = (
+        NO_MATCHING_DISTRIBUTION in result.stderr
+        and not any(error in result.stderr for error in NETWORK_ERRORS)
+    )
+    if not (allow_source_build and missing_wheel):
+        raise subprocess.CalledProcessError(result.returncode, result.args)
+    
+    # No wheel for this platform, let pip build from source
+    subprocess.check_call(command)
+
 def install_package(package):
     """Install a package using pip"""
     try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+        pip_install(package)
         print(f"✅ Installed {package}")
         return True
     except subprocess.CalledProcessError:
         print(f"❌ Failed to install {package}")
         return False
 
+def install_packages(packages):
+    """Install all packages with a single pip invocation"""
+    try:
+        # The per-package fallback retries source builds, no need to do it twice
+        pip_install("--upgrade", *packages, allow_source_build=False)
+        print(f"✅ Installed {len(packages)} packages")
+        return True
+    except subprocess.CalledProcessError:
+        print("⚠️  Batch install failed, installing packages one by one...")
+        return False
+
 def main():
     """Install all required packages"""
     print("🔧 Setting up PanDerm conversion environment...")
@@ -43,9 +85,11 @@ def main():
     print("Installing required packages...")
     failed_packages = []
     
-    for package in packages:
-        if not install_package(package):
-            failed_packages.append(package)
+    # One resolver pass for everything; fall back per package to localize failures
+    if not install_packages(packages):
+        for package in packages:
+            if not install_package(package):
+                failed_packages.append(package)
     
     if failed_packages:
         print(f"\n❌ Failed to install packages: {failed_packages}")
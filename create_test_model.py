@@ -5,16 +5,134 @@ This script creates a dummy model structure for testing the local inference impl
 """
 
 import os
+import shutil
+import tempfile
+import importlib.util
+from pathlib import Path
+
+# Checked without importing: coremltools pulls in protobuf, sympy and more
+HAS_COREMLTOOLS = importlib.util.find_spec("coremltools") is not None
+
+PACKAGE_DIR = "PanDerm/PanDerm.mlpackage"
+
+# Written into the test model's short_description, identifies packages this script made
+TEST_MODEL_DESCRIPTION = "PanDerm test model (random weights) for local inference testing."
+
+# Must match LocalInferenceService: 224x224 RGB image in, 9 skin condition logits out
+INPUT_SHAPE = (1, 3, 224, 224)
+NUM_CLASSES = 9
+
+def package_size(path):
+    """Size in bytes of a model file or .mlpackage directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    
+    total = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+def existing_package_kind():
+    """Classify the package at PACKAGE_DIR as None, placeholder, test or converted"""
+    model_path = Path(PACKAGE_DIR) / "Data" / "com.apple.CoreML" / "model.mlmodel"
+    if not model_path.is_file():
+        return None
+    
+    # Byte-level checks, the spec stores short_description as plain text
+    data = model_path.read_bytes()
+    if data.startswith(b"# Dummy CoreML model"):
+        return "placeholder"
+    if TEST_MODEL_DESCRIPTION.encode() in data:
+        return "test"
+    return "converted"
+
+def keep_existing_package():
+    """Report and return True when PACKAGE_DIR holds a model that must not be overwritten"""
+    kind = existing_package_kind()
+    if kind == "test":
+        print(f"✅ Test model package at {PACKAGE_DIR} is up to date (delete it to regenerate)")
+        return True
+    if kind == "converted":
+        print(f"⚠️  {PACKAGE_DIR} holds a converted PanDerm model, leaving it in place")
+        return True
+    return False
+
+def create_model_package():
+    """Create a small but valid .mlpackage with the app's input/output contract"""
+    
+    # Never replace the committed test model or a model from convert_panderm_to_coreml.py
+    if keep_existing_package():
+        return True
+    
+    print("Creating PanDerm test model with the MIL builder...")
+    
+    try:
+        import numpy as np
+        import coremltools as ct
+        from coremltools.converters.mil import Builder as mb
+        
+        rng = np.random.default_rng(0)
+        weight = rng.standard_normal((NUM_CLASSES, INPUT_SHAPE[1])).astype(np.float32)
+        bias = np.zeros(NUM_CLASSES, dtype=np.float32)
+        
+        @mb.program(input_specs=[mb.TensorSpec(shape=INPUT_SHAPE)], opset_version=ct.target.iOS17)
+        def prog(input):
+            # Global average pooling stands in for the ViT backbone
+            features = mb.reduce_mean(x=input, axes=[2, 3])
+            return mb.linear(x=features, weight=weight, bias=bias, name="logits")
+        
+        model = ct.convert(
+            prog,
+            inputs=[ct.ImageType(name="input", shape=INPUT_SHAPE, scale=1.0 / 255.0, color_layout=ct.colorlayout.RGB)],
+            convert_to="mlprogram",
+            compute_precision=ct.precision.FLOAT16,
+            compute_units=ct.ComputeUnit.CPU_AND_NE,
+            minimum_deployment_target=ct.target.iOS17
+        )
+        model.short_description = (
+            f"{TEST_MODEL_DESCRIPTION} "
+            "Load with MLModelConfiguration.computeUnits = .cpuAndNeuralEngine."
+        )
+        
+        # Save to a temporary directory on the same filesystem, then swap it into place
+        tmp_dir = tempfile.mkdtemp(prefix=".panderm-", dir=".")
+        try:
+            tmp_package = os.path.join(tmp_dir, os.path.basename(PACKAGE_DIR))
+            model.save(tmp_package)
+            if os.path.exists(PACKAGE_DIR):
+                shutil.rmtree(PACKAGE_DIR)
+            os.replace(tmp_package, PACKAGE_DIR)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        
+        print(f"✅ Created test model package at {PACKAGE_DIR}")
+        print(f"  Size: {package_size(PACKAGE_DIR) / 1024:.1f} KB")
+        print("Note: This model has random weights - replace with actual model for production")
+        
+        return True
+        
+    except Exception as e:
+        print(f"❌ Failed to create test model: {e}")
+        return False
 
 def create_dummy_package():
     """Create a dummy .mlpackage structure for testing"""
     
+    if keep_existing_package():
+        return True
+    
     print("Creating dummy PanDerm model package structure...")
     
     try:
-        # Create the directory structure
-        package_dir = "PanDerm/PanDerm.mlpackage"
-        os.makedirs(f"{package_dir}/Data/com.apple.CoreML", exist_ok=True)
+        package_dir = Path(PACKAGE_DIR)
+        manifest_path = package_dir / "Manifest.json"
+        model_path = package_dir / "Data" / "com.apple.CoreML" / "model.mlmodel"
         
         # Create a minimal Manifest.json
         manifest_content = '''{
@@ -28,13 +146,22 @@ def create_dummy_package():
     }
 }'''
         
-        with open(f"{package_dir}/Manifest.json", 'w') as f:
-            f.write(manifest_content)
-        
         # Create a minimal model file indicator
-        with open(f"{package_dir}/Data/com.apple.CoreML/model.mlmodel", 'w') as f:
-            f.write("# Dummy CoreML model for testing PanDerm local inference\n")
-            f.write("# This should be replaced with actual trained model\n")
+        model_content = (
+            "# Dummy CoreML model for testing PanDerm local inference\n"
+            "# This should be replaced with actual trained model\n"
+        )
+        
+        # Nothing to do when a previous run already wrote the same files
+        if (manifest_path.is_file() and model_path.is_file()
+                and manifest_path.read_text() == manifest_content
+                and model_path.read_text() == model_content):
+            print(f"✅ Dummy package at {package_dir} is up to date")
+            return True
+        
+        model_path.parent.mkdir(parents=True, exist_ok=True)
+        manifest_path.write_text(manifest_content)
+        model_path.write_text(model_content)
         
         print(f"✅ Created dummy package structure at {package_dir}")
         print("✅ Model package is ready for Swift integration testing")
@@ -46,12 +173,20 @@ def create_dummy_package():
         print(f"❌ Failed to create dummy package: {e}")
         return False
 
+def create_package():
+    """Create the test model package, falling back to a placeholder without coremltools"""
+    if HAS_COREMLTOOLS:
+        return create_model_package()
+    
+    print("coremltools not installed, creating a placeholder package instead")
+    return create_dummy_package()
+
 if __name__ == "__main__":
     print("PanDerm Test Model Generator")
     print("=" * 40)
     
     try:
-        success = create_dummy_package()
+        success = create_package()
         
         if success:
             print("\n" + "=" * 40)
@@ -59,7 +194,10 @@ if __name__ == "__main__":
             print("\nWhat was created:")
             print("📁 PanDerm/PanDerm.mlpackage/ - Model package directory")
             print("📄 Manifest.json - Package manifest file")  
-            print("📄 model.mlmodel - Placeholder model file")
+            if HAS_COREMLTOOLS:
+                print("📄 model.mlmodel - Linear classifier test model")
+            else:
+                print("📄 model.mlmodel - Placeholder model file")
             print("\nNext steps:")
             print("1. The dummy model package is ready for Swift testing")
             print("2. Build and run the iOS app to test the inference pipeline")